@@ -6,6 +6,9 @@
 # model parameters should converge upon the correct values regarless
 # of the initialization values.
 #
+# See mixtureEM.py for a general version that fits any number of
+# components in any number of dimensions.
+#
 # Karen Lewis (June 10, 2014)
 
 from matplotlib import pyplot as plt
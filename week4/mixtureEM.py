@@ -0,0 +1,904 @@
+#!/usr/bin/python
+
+''' Expectation-Maximization for Gaussian mixture models.
+
+This is the general version of cheapEM.py. Instead of keeping one scalar per
+component (mu1, mu2, mu3, ...) and repeating every update by hand, the model
+parameters are stored as arrays:
+
+    weights : (K,)       mixing coefficients (the a's in cheapEM)
+    means   : (K, D)     component means (the mu's)
+    covars  : covariance matrices, whose shape depends on covariance_type
+        'full'  (K, D, D)  one full covariance matrix per component
+        'diag'  (K, D)     one diagonal covariance (variances) per component
+        'tied'  (D, D)     a single full covariance shared by all components
+
+and the responsibilities (the w's in cheapEM) are a single (N, K) matrix. The
+E and M steps follow equations 4.21 and 4.26 - 4.28 of the book, generalized
+to K components in D dimensions.
+
+All densities are handled as logarithms. Raw densities underflow to zero for
+points far from every component, which turns the ratios of 4.21 into 0/0; the
+log-sum-exp form of the responsibilities does not.
+
+Progress is reported through callbacks (see fit_gmm) so that the fitting loop
+itself never prints or draws anything. print_progress and plot_progress are
+ready-made subscribers.
+
+'''
+
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+COVARIANCE_TYPES = ('full', 'diag', 'tied')
+
+def log_gaussian_density(X, means, covars, covariance_type='full'):
+
+    ''' Evaluates the log density of every component at every data point.
+
+    Parameters
+    ----------
+    X : array-like
+        Data of shape (N, D).
+    means : array-like
+        Component means of shape (K, D).
+    covars : array-like
+        Component covariances, see the module docstring for the shapes.
+    covariance_type : str
+        One of 'full', 'diag' or 'tied'.
+
+    Returns
+    -------
+    log_density : array-like
+        Array of shape (N, K) holding log N(x_i | mu_k, Sigma_k).
+
+    '''
+
+    N, D = X.shape
+    K = means.shape[0]
+
+    if covariance_type == 'diag':
+        # Expand (x - mu)^2 / var so that the (N, K) matrix of Mahalanobis
+        # distances is built from matrix products instead of an (N, K, D)
+        # temporary.
+        precisions = 1. / covars
+        maha = (np.dot(X ** 2, precisions.T)
+                - 2. * np.dot(X, (means * precisions).T)
+                + np.sum(means ** 2 * precisions, axis=1))
+        log_det = np.sum(np.log(covars), axis=1)
+    else:
+        if covariance_type == 'tied':
+            covars = np.tile(covars, (K, 1, 1))
+
+        # Whiten the data with the inverse Cholesky factor of each
+        # covariance: |L^-1 (x - mu)|^2 is the Mahalanobis distance.
+        prec_chol = np.linalg.inv(np.linalg.cholesky(covars))
+        maha = np.empty((N, K))
+        for k in range(K):
+            y = np.dot(X - means[k], prec_chol[k].T)
+            maha[:, k] = np.sum(y ** 2, axis=1)
+        log_det = -2. * np.sum(np.log(np.diagonal(prec_chol, axis1=1,
+            axis2=2)), axis=1)
+
+    return -0.5 * (D * np.log(2 * np.pi) + log_det + maha)
+
+def logsumexp(a, axis=None):
+
+    ''' Computes log(sum(exp(a))) without overflow or underflow by factoring
+    out the largest element.
+
+    '''
+
+    a_max = np.max(a, axis=axis, keepdims=True)
+    a_max[~np.isfinite(a_max)] = 0.
+    out = np.log(np.sum(np.exp(a - a_max), axis=axis, keepdims=True)) + a_max
+
+    if axis is None:
+        return out.item()
+    return np.squeeze(out, axis=axis)
+
+def e_step(X, weights, means, covars, covariance_type='full'):
+
+    ''' Computes the responsibilities following equation 4.21.
+
+    Parameters
+    ----------
+    X : array-like
+        Data of shape (N, D).
+    weights, means, covars : array-like
+        Current model parameters.
+    covariance_type : str
+        One of 'full', 'diag' or 'tied'.
+
+    Returns
+    -------
+    resp : array-like
+        Responsibilities of shape (N, K). Each row sums to one.
+    log_likelihood : float
+        Log-likelihood of the data under the current parameters.
+
+    '''
+
+    # Logarithms of the numerators of 4.21, one column per component
+    log_num = np.log(weights) + log_gaussian_density(X, means, covars,
+                                                     covariance_type)
+
+    # The denominator is the current model prediction for each data point
+    log_den = logsumexp(log_num, axis=1)
+
+    resp = np.exp(log_num - log_den[:, np.newaxis])
+
+    return resp, np.sum(log_den)
+
+def m_step(X, resp, covariance_type='full', reg_covar=1e-6):
+
+    ''' Updates the model parameters from the responsibilities following
+    equations 4.26 - 4.28.
+
+    Parameters
+    ----------
+    X : array-like
+        Data of shape (N, D).
+    resp : array-like
+        Responsibilities of shape (N, K).
+    covariance_type : str
+        One of 'full', 'diag' or 'tied'.
+    reg_covar : float
+        Small value added to the diagonal of the covariances to keep them
+        positive definite.
+
+    Returns
+    -------
+    weights, means, covars : array-like
+        The updated model parameters.
+
+    '''
+
+    N, D = X.shape
+    nk = np.sum(resp, axis=0) + 10 * np.finfo(resp.dtype).eps
+
+    # 4.28 and 4.26
+    weights = nk / N
+    means = np.dot(resp.T, X) / nk[:, np.newaxis]
+
+    # 4.27
+    if covariance_type == 'full':
+        covars = np.empty((len(nk), D, D))
+        for k in range(len(nk)):
+            diff = X - means[k]
+            covars[k] = np.dot(resp[:, k] * diff.T, diff) / nk[k]
+            covars[k].flat[::D + 1] += reg_covar
+    elif covariance_type == 'diag':
+        covars = (np.dot(resp.T, X ** 2) / nk[:, np.newaxis] - means ** 2
+                  + reg_covar)
+    elif covariance_type == 'tied':
+        covars = (np.dot(X.T, X) - np.dot(nk * means.T, means)) / N
+        covars.flat[::D + 1] += reg_covar
+    else:
+        raise ValueError('covariance_type must be one of %s' %
+                         (COVARIANCE_TYPES,))
+
+    return weights, means, covars
+
+def kmeans_plusplus(X, n_components, seed=None):
+
+    ''' Chooses initial means with the k-means++ rule: the first mean is a
+    random data point, and every following one is a data point drawn with
+    probability proportional to its squared distance from the nearest mean
+    chosen so far. This spreads the starting means over the data.
+
+    Parameters
+    ----------
+    X : array-like
+        Data of shape (N, D).
+    n_components : int
+        Number of means to choose.
+    seed : int or numpy.random.Generator, optional
+        Seed for the random draws.
+
+    Returns
+    -------
+    means : array-like
+        Array of shape (n_components, D).
+
+    '''
+
+    rng = np.random.default_rng(seed)
+    N = len(X)
+
+    means = np.empty((n_components, X.shape[1]))
+    means[0] = X[rng.integers(N)]
+    closest = np.sum((X - means[0]) ** 2, axis=1)
+
+    for k in range(1, n_components):
+        total = np.sum(closest)
+        if total > 0:
+            index = rng.choice(N, p=closest / total)
+        else:
+            index = rng.integers(N)
+        means[k] = X[index]
+        closest = np.minimum(closest, np.sum((X - means[k]) ** 2, axis=1))
+
+    return means
+
+def init_params(X, n_components, covariance_type='full', seed=None,
+        init='kmeans++'):
+
+    ''' Chooses starting parameters: the means are chosen by kmeans_plusplus
+    (or are randomly selected data points), every component gets the
+    covariance of the whole data set and the weights are all equal.
+
+    Parameters
+    ----------
+    X : array-like
+        Data of shape (N, D).
+    n_components : int
+        Number of mixture components K.
+    covariance_type : str
+        One of 'full', 'diag' or 'tied'.
+    seed : int or numpy.random.Generator, optional
+        Seed for the choice of the initial means.
+    init : str
+        'kmeans++' uses kmeans_plusplus. 'random' picks the means uniformly
+        from the data; since every component starts with the same covariance,
+        two means drawn from one cluster give a nearly symmetric start that
+        EM leaves only slowly, and the tolerance test of fit_gmm can stop it
+        there.
+
+    Returns
+    -------
+    weights, means, covars : array-like
+        The initial model parameters.
+
+    '''
+
+    rng = np.random.default_rng(seed)
+    N, D = X.shape
+
+    weights = np.ones(n_components) / n_components
+    if init == 'kmeans++':
+        means = kmeans_plusplus(X, n_components, seed=rng)
+    elif init == 'random':
+        means = X[rng.choice(N, n_components, replace=False)]
+    else:
+        raise ValueError("init must be 'random' or 'kmeans++'")
+
+    covars = _data_covars(X, n_components, covariance_type)
+
+    return weights, means, covars
+
+def fit_gmm(X, n_components, covariance_type='full', weights=None,
+        means=None, covars=None, max_iter=100, tol=1e-6, reg_covar=1e-6,
+        seed=None, init='kmeans++', callback=None):
+
+    ''' Fits a Gaussian mixture model to data with the EM algorithm.
+
+    Parameters
+    ----------
+    X : array-like
+        Data of shape (N, D). One-dimensional data of shape (N,) is treated
+        as (N, 1).
+    n_components : int
+        Number of mixture components K.
+    covariance_type : str
+        One of 'full', 'diag' or 'tied'.
+    weights, means, covars : array-like, optional
+        Initial guesses for the parameters. Whichever are not given are set
+        by init_params.
+    max_iter : int
+        Maximum number of EM iterations.
+    tol : float
+        The fit stops once the log-likelihood per data point changes by less
+        than tol between iterations. Use tol=0 to always run max_iter
+        iterations.
+    reg_covar : float
+        Regularization added to the diagonal of the covariances.
+    seed : int or numpy.random.Generator, optional
+        Seed used by init_params.
+    init : str
+        Initialization of the means when none are given, see init_params.
+    callback : callable or list of callables, optional
+        Called after every iteration with a dictionary holding the
+        'iteration' number, the current 'weights', 'means', 'covars' and
+        'resp', the data 'X', the current 'log_likelihood', the wall time of
+        the iteration 'iteration_time' and the total time since the start
+        'elapsed', in seconds. Callbacks must not modify the arrays.
+
+    Returns
+    -------
+    result : dict
+        Dictionary with the fitted 'weights', 'means' and 'covars', the
+        final responsibilities 'resp' and the 'covariance_type'. It also
+        holds the number of iterations performed 'n_iter', whether the
+        tolerance was reached 'converged', and the 'log_likelihood' trace:
+        an array of length n_iter + 1 whose element i is the log-likelihood
+        after i iterations.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> X = np.concatenate([np.random.normal(-1, 1.5, 3000),
+    ...                     np.random.normal(3, 0.5, 2000)])
+    >>> result = fit_gmm(X, 2)
+    >>> result['means'].shape
+    (2, 1)
+
+    '''
+
+    X = _as_2d(X)
+
+    weights, means, covars = _starting_params(X, n_components,
+        covariance_type, weights, means, covars, seed, init)
+
+    # Calculate an initial set of responsibilities, then iterate on the
+    # maximization and expectation steps
+    callbacks = _as_callbacks(callback)
+    start = time.time()
+
+    resp, log_likelihood = e_step(X, weights, means, covars, covariance_type)
+    trace = [log_likelihood]
+    converged = False
+
+    for i in range(max_iter):
+        tick = time.time()
+        weights, means, covars = m_step(X, resp, covariance_type, reg_covar)
+        resp, log_likelihood = e_step(X, weights, means, covars,
+                                      covariance_type)
+        trace.append(log_likelihood)
+
+        if callbacks:
+            now = time.time()
+            info = {'iteration': i + 1, 'X': X, 'weights': weights,
+                    'means': means, 'covars': covars, 'resp': resp,
+                    'log_likelihood': log_likelihood,
+                    'iteration_time': now - tick, 'elapsed': now - start}
+            for function in callbacks:
+                function(info)
+
+        if abs(trace[-1] - trace[-2]) < tol * len(X):
+            converged = True
+            break
+
+    return {'weights': weights,
+            'means': means,
+            'covars': covars,
+            'resp': resp,
+            'covariance_type': covariance_type,
+            'n_iter': len(trace) - 1,
+            'converged': converged,
+            'log_likelihood': np.array(trace)}
+
+def sufficient_statistics(X, resp, covariance_type='full'):
+
+    ''' Computes the sufficient statistics of a batch, averaged per point.
+
+    Parameters
+    ----------
+    X : array-like
+        Data of shape (N, D).
+    resp : array-like
+        Responsibilities of shape (N, K).
+    covariance_type : str
+        One of 'full', 'diag' or 'tied'.
+
+    Returns
+    -------
+    s0, s1, s2 : array-like
+        Zeroth (K,), first (K, D) and second moments of the data weighted by
+        the responsibilities, divided by N. The second moment has shape
+        (K, D, D), (K, D) or (D, D) for 'full', 'diag' and 'tied'
+        covariances.
+
+    '''
+
+    N, D = X.shape
+
+    s0 = np.sum(resp, axis=0) / N
+    s1 = np.dot(resp.T, X) / N
+
+    if covariance_type == 'full':
+        s2 = np.empty((resp.shape[1], D, D))
+        for k in range(resp.shape[1]):
+            s2[k] = np.dot(resp[:, k] * X.T, X) / N
+    elif covariance_type == 'diag':
+        s2 = np.dot(resp.T, X ** 2) / N
+    else:
+        s2 = np.dot(X.T, X) / N
+
+    return s0, s1, s2
+
+def params_from_statistics(s0, s1, s2, covariance_type='full',
+        reg_covar=1e-6):
+
+    ''' The M step expressed in terms of the averaged sufficient statistics
+    returned by sufficient_statistics.
+
+    Returns
+    -------
+    weights, means, covars : array-like
+        The model parameters.
+
+    '''
+
+    D = s1.shape[1]
+    nk = s0 + 10 * np.finfo(s0.dtype).eps
+
+    weights = nk / np.sum(nk)
+    means = s1 / nk[:, np.newaxis]
+
+    if covariance_type == 'full':
+        covars = (s2 / nk[:, np.newaxis, np.newaxis]
+                  - means[:, :, np.newaxis] * means[:, np.newaxis, :])
+        covars[:, range(D), range(D)] += reg_covar
+    elif covariance_type == 'diag':
+        covars = s2 / nk[:, np.newaxis] - means ** 2 + reg_covar
+    else:
+        covars = (s2 - np.dot(nk * means.T, means)) / np.sum(nk)
+        covars.flat[::D + 1] += reg_covar
+
+    return weights, means, covars
+
+def iter_chunks(data, chunk_size=10000, n_epochs=1, shuffle=True, seed=None,
+        buffer_chunks=1):
+
+    ''' Yields the data in chunks of rows.
+
+    Parameters
+    ----------
+    data : array-like, str or iterable
+        Either an array (including a numpy.memmap), the name of a .npy file,
+        which is memory-mapped rather than loaded, or an iterable (e.g. a
+        generator) that yields arrays of rows.
+    chunk_size : int
+        Number of rows per chunk for array and file input.
+    n_epochs : int
+        Number of passes over array and file input. Iterables can only be
+        consumed once and are always passed over a single time.
+    shuffle : bool
+        Visit the chunks of array and file input in a random order in each
+        epoch. The rows within a chunk stay contiguous, so reads from a
+        memory-mapped file remain sequential. This does not mix rows between
+        chunks; see buffer_chunks.
+    seed : int or numpy.random.Generator, optional
+        Seed for the chunk order and the buffered shuffle.
+    buffer_chunks : int
+        If larger than 1, this many consecutive chunks (in the order above,
+        or as yielded by an iterable) are pooled, their rows shuffled, and
+        the pool yielded again in chunks of the original sizes. Use it when
+        the rows are sorted, e.g. by cluster, so that single chunks are not
+        representative of the data. Memory grows to buffer_chunks chunks.
+
+    Yields
+    ------
+    chunk : array-like
+        Array of shape (n, D) holding the next n rows (n <= chunk_size for
+        array and file input).
+
+    '''
+
+    rng = np.random.default_rng(seed)
+    chunks = _contiguous_chunks(data, chunk_size, n_epochs, shuffle, rng)
+    if buffer_chunks <= 1:
+        for chunk in chunks:
+            yield chunk
+        return
+
+    pool = []
+    for chunk in chunks:
+        pool.append(chunk)
+        if len(pool) == buffer_chunks:
+            for mixed in _mix_chunks(pool, rng):
+                yield mixed
+            pool = []
+    if pool:
+        for mixed in _mix_chunks(pool, rng):
+            yield mixed
+
+def _contiguous_chunks(data, chunk_size, n_epochs, shuffle, rng):
+
+    # The chunks of iter_chunks before any buffered shuffle
+    if isinstance(data, str):
+        data = np.load(data, mmap_mode='r')
+
+    if not hasattr(data, 'shape'):
+        for chunk in data:
+            yield _as_2d(chunk)
+        return
+
+    starts = np.arange(0, len(data), chunk_size)
+    for epoch in range(n_epochs):
+        if shuffle:
+            starts = rng.permutation(starts)
+        for start in starts:
+            yield _as_2d(data[start:start + chunk_size])
+
+def _mix_chunks(chunks, rng):
+
+    # Shuffles the rows of a pool of chunks and splits them again into
+    # chunks of the same sizes
+    rows = np.concatenate(chunks)
+    rows = rows[rng.permutation(len(rows))]
+    ends = np.cumsum([len(chunk) for chunk in chunks])
+
+    return np.split(rows, ends[:-1])
+
+def fit_gmm_online(data, n_components, covariance_type='full', weights=None,
+        means=None, covars=None, chunk_size=10000, n_epochs=1, kappa=0.6,
+        t0=2., reg_covar=1e-6, seed=None, init='kmeans++', callback=None,
+        buffer_chunks=1):
+
+    ''' Fits a Gaussian mixture model with online (stochastic) EM, for data
+    sets that do not fit in memory.
+
+    Only one chunk of data is held at a time. Each chunk gets an E step with
+    the current parameters, and its sufficient statistics S_chunk are blended
+    into the running statistics S with a decreasing step size
+
+        eta_t = (t + t0) ** -kappa * n / n_max,
+        S <- (1 - eta_t) S + eta_t S_chunk
+
+    where n is the size of the chunk and n_max the largest chunk size so
+    far, so a short final chunk gets a proportionally smaller step. The
+    parameters are then recomputed from S. For 0.5 < kappa <= 1 this
+    converges to a maximum of the likelihood (Cappe & Moulines 2009).
+
+    Each chunk must be a representative sample of the data. If the rows
+    are ordered (e.g. a catalog sorted by type or position), every chunk
+    comes from a few clusters and the estimate drifts toward the last
+    chunks seen; shuffling the order of whole chunks does not help. Pool
+    and shuffle several chunks with buffer_chunks, or shuffle the rows
+    beforehand.
+
+    Parameters
+    ----------
+    data : array-like, str or iterable
+        Data source, see iter_chunks. Memory-mapped arrays and .npy file
+        names are read one chunk at a time.
+    n_components : int
+        Number of mixture components K.
+    covariance_type : str
+        One of 'full', 'diag' or 'tied'.
+    weights, means, covars : array-like, optional
+        Initial guesses for the parameters. Whichever are not given are set
+        by init_params from the first chunk.
+    chunk_size : int
+        Number of rows per chunk for array and file input.
+    n_epochs : int
+        Number of passes over array and file input.
+    kappa : float
+        Decay exponent of the step size, between 0.5 and 1. Smaller values
+        forget old chunks faster.
+    t0 : float
+        Offset of the step size schedule. Larger values damp the first
+        updates.
+    reg_covar : float
+        Regularization added to the diagonal of the covariances.
+    seed : int or numpy.random.Generator, optional
+        Seed for the initial parameters and the chunk order.
+    init : str
+        Initialization of the means when none are given, see init_params.
+    callback : callable or list of callables, optional
+        Called after every chunk, as in fit_gmm. 'X' and 'resp' refer to the
+        current chunk and 'log_likelihood' is its mean per point.
+    buffer_chunks : int
+        Number of chunks whose rows are shuffled together, see iter_chunks.
+
+    Returns
+    -------
+    result : dict
+        Dictionary with the fitted 'weights', 'means', 'covars' and
+        'covariance_type', the number of chunks processed 'n_batches' and the
+        'log_likelihood' trace: the mean log-likelihood per point of each
+        chunk, evaluated before the chunk updates the parameters.
+
+    Examples
+    --------
+    >>> result = fit_gmm_online('photometry.npy', 5, 'diag',
+    ...                         chunk_size=100000, n_epochs=2)
+
+    '''
+
+    rng = np.random.default_rng(seed)
+    callbacks = _as_callbacks(callback)
+    start = time.time()
+    stats = None
+    trace = []
+    n_max = 0
+
+    for t, X in enumerate(iter_chunks(data, chunk_size, n_epochs, seed=rng,
+                                      buffer_chunks=buffer_chunks)):
+        tick = time.time()
+        if stats is None:
+            weights, means, covars = _starting_params(X, n_components,
+                covariance_type, weights, means, covars, rng, init)
+
+        resp, log_likelihood = e_step(X, weights, means, covars,
+                                      covariance_type)
+        trace.append(log_likelihood / len(X))
+
+        chunk_stats = sufficient_statistics(X, resp, covariance_type)
+        n_max = max(n_max, len(X))
+        if stats is None:
+            stats = chunk_stats
+        else:
+            eta = (t + t0) ** -kappa * len(X) / float(n_max)
+            stats = [(1 - eta) * s + eta * c
+                     for s, c in zip(stats, chunk_stats)]
+
+        weights, means, covars = params_from_statistics(*stats,
+            covariance_type=covariance_type, reg_covar=reg_covar)
+
+        if callbacks:
+            now = time.time()
+            info = {'iteration': t + 1, 'X': X, 'weights': weights,
+                    'means': means, 'covars': covars, 'resp': resp,
+                    'log_likelihood': trace[-1],
+                    'iteration_time': now - tick, 'elapsed': now - start}
+            for function in callbacks:
+                function(info)
+
+    if stats is None:
+        raise ValueError('data is empty')
+
+    return {'weights': weights,
+            'means': means,
+            'covars': covars,
+            'covariance_type': covariance_type,
+            'n_batches': len(trace),
+            'log_likelihood': np.array(trace)}
+
+def fit_gmm_multistart(X, n_components, n_init=10, workers=None, seed=None,
+        init='kmeans++', **kwargs):
+
+    ''' Runs fit_gmm from n_init different starting points and keeps the fit
+    with the highest likelihood.
+
+    EM only finds a local maximum of the likelihood, so the result depends on
+    the starting guesses. The restarts are independent and are run in
+    parallel on a pool of processes.
+
+    Parameters
+    ----------
+    X : array-like
+        Data of shape (N, D) or (N,).
+    n_components : int
+        Number of mixture components K.
+    n_init : int
+        Number of restarts.
+    workers : int, optional
+        Number of worker processes. The default runs the restarts one after
+        the other in this process.
+    seed : int, optional
+        Seed for the restarts. Each run gets its own independent stream,
+        spawned from numpy.random.SeedSequence(seed), so the results do not
+        depend on the number of workers.
+    init : str
+        How to choose the starting means, 'kmeans++' or 'random'.
+    **kwargs
+        Passed on to fit_gmm, e.g. covariance_type, max_iter or tol.
+
+    Returns
+    -------
+    best : dict
+        The fit_gmm result of the run with the highest final log-likelihood.
+    runs : list of dict
+        One summary per run, in order, with the 'run' number, the final
+        'log_likelihood', 'n_iter' and 'converged'.
+
+    Examples
+    --------
+    >>> best, runs = fit_gmm_multistart(X, 5, n_init=32, workers=8, seed=42)
+
+    '''
+
+    X = _as_2d(X)
+    seeds = np.random.SeedSequence(seed).spawn(n_init)
+
+    if workers is None or workers <= 1:
+        _set_worker_data(X)
+        results = [_multistart_run(n_components, s, init, kwargs)
+                   for s in seeds]
+        _set_worker_data(None)
+    else:
+        # The data is sent to every worker once, when the pool starts,
+        # rather than once per run.
+        with ProcessPoolExecutor(max_workers=workers,
+                initializer=_set_worker_data, initargs=(X,)) as pool:
+            results = list(pool.map(_multistart_run,
+                                    [n_components] * n_init, seeds,
+                                    [init] * n_init, [kwargs] * n_init))
+        _set_worker_data(None)
+
+    runs = [{'run': i,
+             'log_likelihood': result['log_likelihood'][-1],
+             'n_iter': result['n_iter'],
+             'converged': result['converged']}
+            for i, result in enumerate(results)]
+
+    best = results[int(np.argmax([run['log_likelihood'] for run in runs]))]
+
+    # Responsibilities are not shipped back from the workers
+    best['resp'] = e_step(X, best['weights'], best['means'], best['covars'],
+                          best['covariance_type'])[0]
+
+    return best, runs
+
+# Data set shared by the multistart runs of one worker process
+_worker_data = None
+
+def _set_worker_data(X):
+    global _worker_data
+    _worker_data = X
+
+def _multistart_run(n_components, seed, init, kwargs):
+    result = fit_gmm(_worker_data, n_components, seed=seed, init=init,
+                     **kwargs)
+    del result['resp']
+    return result
+
+def print_progress(every=5):
+
+    ''' Returns a callback for fit_gmm that prints the parameters every few
+    iterations, like cheapEM.py does.
+
+    Parameters
+    ----------
+    every : int
+        Print every this many iterations.
+
+    Returns
+    -------
+    callback : callable
+
+    '''
+
+    def callback(info):
+        if info['iteration'] % every == 0:
+            print('Iteration %i done (%.3f s)' % (info['iteration'],
+                                                  info['iteration_time']))
+            print('mu: %s' % info['means'].ravel())
+            print('covariance: %s' % info['covars'].ravel())
+            print('scale: %s' % info['weights'])
+            print('log-likelihood: %.4f' % info['log_likelihood'])
+            print('')
+
+    return callback
+
+def plot_progress(every=5, max_points=2000, filename=None, seed=0):
+
+    ''' Returns a callback for fit_gmm that plots the responsibilities
+    against the first coordinate of the data every few iterations.
+
+    Only a random subset of the points is drawn. Without a filename the
+    figure is shown in interactive mode when the callback is created and
+    redrawn with pyplot.pause after each frame, so the window updates while
+    the fit keeps running. Headless runs (no display, or a non-interactive
+    backend such as Agg) need a filename to save the frames instead.
+    matplotlib is only imported when the callback is created.
+
+    Parameters
+    ----------
+    every : int
+        Plot every this many iterations.
+    max_points : int
+        Maximum number of points drawn per frame.
+    filename : str, optional
+        If given, each frame is saved to filename % iteration, e.g.
+        'em_%03i.png', instead of being drawn on screen.
+    seed : int, optional
+        Seed for the choice of the plotted points.
+
+    Returns
+    -------
+    callback : callable
+
+    '''
+
+    import matplotlib.pyplot as plt
+
+    rng = np.random.default_rng(seed)
+    ax = plt.figure().add_subplot(111)
+    if filename is None:
+        plt.ion()
+        ax.figure.show()
+
+    def callback(info):
+        if info['iteration'] % every != 0:
+            return
+
+        X, resp = info['X'], info['resp']
+        if len(X) > max_points:
+            subset = rng.choice(len(X), max_points, replace=False)
+            X, resp = X[subset], resp[subset]
+
+        ax.cla()
+        for k in range(resp.shape[1]):
+            ax.scatter(X[:, 0], resp[:, k], s=4, label='component %i' % k)
+        ax.set_xlabel('x')
+        ax.set_ylabel('Responsibility')
+        ax.set_title('Iteration %i' % info['iteration'])
+        ax.legend(loc=0)
+
+        if filename is not None:
+            ax.figure.savefig(filename % info['iteration'])
+        else:
+            ax.figure.canvas.draw_idle()
+            plt.pause(1e-3)
+
+    return callback
+
+def _data_covars(X, n_components, covariance_type):
+
+    # Every component gets the covariance of the whole data set
+    cov = np.atleast_2d(np.cov(X, rowvar=False))
+    if covariance_type == 'full':
+        return np.tile(cov, (n_components, 1, 1))
+    elif covariance_type == 'diag':
+        return np.tile(np.diag(cov), (n_components, 1))
+    elif covariance_type == 'tied':
+        return cov
+    raise ValueError('covariance_type must be one of %s' %
+                     (COVARIANCE_TYPES,))
+
+def _as_2d(X):
+    X = np.asarray(X, dtype=float)
+    if X.ndim == 1:
+        X = X[:, np.newaxis]
+    return X
+
+def _as_callbacks(callback):
+    if callback is None:
+        return []
+    if callable(callback):
+        return [callback]
+    return list(callback)
+
+def _starting_params(X, n_components, covariance_type, weights, means,
+        covars, seed, init):
+
+    # Fill in whichever parameters the caller did not guess
+    if covariance_type not in COVARIANCE_TYPES:
+        raise ValueError('covariance_type must be one of %s' %
+                         (COVARIANCE_TYPES,))
+
+    # Only the random means need N >= K data points
+    if means is None:
+        start_weights, means, start_covars = init_params(X, n_components,
+            covariance_type, seed, init)
+    else:
+        means = np.asarray(means, float)
+        start_weights = np.ones(n_components) / n_components
+        start_covars = None if covars is not None else \
+            _data_covars(X, n_components, covariance_type)
+
+    weights = start_weights if weights is None else np.asarray(weights, float)
+    covars = start_covars if covars is None else np.asarray(covars, float)
+
+    return weights, means.reshape(n_components, X.shape[1]), covars
+
+def main():
+
+    ''' Repeats the cheapEM.py example: three 1-D Gaussian components
+    started from the same guesses.
+
+    '''
+
+    np.random.seed(1)
+    Ndata = 10000
+    component = np.random.choice(3, Ndata, p=[0.3, 0.5, 0.2])
+    X = np.random.normal(np.array([-1., 0., 3.])[component],
+                         np.array([1.5, 0.3, 0.5])[component])
+
+    result = fit_gmm(X, 3,
+                     means=[-0.9, 0.1, 2.9],
+                     covars=np.array([1.3, 0.25, 0.55])[:, None, None] ** 2,
+                     weights=[0.25, 0.55, 0.25],
+                     callback=print_progress(every=5))
+
+    print('converged after %i iterations, log-likelihood %.2f' %
+          (result['n_iter'], result['log_likelihood'][-1]))
+
+if __name__ == '__main__':
+    main()
+
@@ -2,7 +2,7 @@
 
 import numpy as np
 import matplotlib.pyplot as plt
-import random
+from bootstrap_intervals import quantiles
 
 def bootstrap(data, num_samples):
 
@@ -28,7 +28,12 @@ def bootstrap(data, num_samples):
     Notes
     -----
     -> arrays can be initialized with numpy.empty
-    -> random samples can be retrieved from an array with random.sample
+    -> random samples can be retrieved from an array with random.sample, but
+    it draws without replacement, which only shuffles the data. Index the
+    data with numpy.random.randint instead so points can be drawn more than
+    once.
+    -> For large samples, or when only a statistic of each resample is
+    needed, use bootstrap_statistic in bootstrap_engine.py.
 
     Examples
     --------
@@ -42,10 +47,7 @@ def bootstrap(data, num_samples):
     (50, 100,)
     '''
 
-    samples = np.empty((num_samples, data.size))
-
-    for i in range(num_samples):
-        samples[i,:] = random.sample(data, data.size)
+    samples = data[np.random.randint(0, data.size, (num_samples, data.size))]
 
     return samples
 
@@ -70,13 +72,12 @@ def calc_bootstrap_error(samples, alpha):
 
     Notes
     -----
-    -> To find the index in an array closest to a given value, use the
-    numpy.argmin function to find the index of the minimum value in an array.
-    For example to find the value closest to 11.1 in an array of 10, 11, and 12:
-        >>> import numpy as np
-        >>> a = np.array([10, 11, 12])
-        >>> print(np.argmin(np.abs(a - 11.1)))
-        1
+    -> The mean is taken over each resample, i.e. along axis=1, giving one
+    mean per resample.
+    -> The errors are the alpha/2 and 1 - alpha/2 quantiles of the means,
+    found with one numpy.partition by bootstrap_intervals.quantiles. Other
+    intervals (basic, BCa) and several alpha levels at once are available
+    from bootstrap_intervals.bootstrap_interval.
 
     Examples
     --------
@@ -88,10 +89,8 @@ def calc_bootstrap_error(samples, alpha):
 
     '''
 
-    means, cdf = calc_cdf(samples)
-    mean = means[np.argmin(np.abs(cdf - 0.5))]
-    error_low = means[np.argmin(np.abs(cdf - alpha/2.))]
-    error_high = means[np.argmin(np.abs(cdf - (1 - alpha/2.)))]
+    mean, error_low, error_high = quantiles(np.mean(samples, axis=1),
+                                            [0.5, alpha/2., 1 - alpha/2.])
 
     return (mean, mean - error_low, error_high - mean)
 
@@ -115,13 +114,13 @@ def calc_cdf(samples):
     Notes
     -----
     -> numpy.sort can be used to sort the means.
-    -> numpy.cumsum can be used to calculate a cumulative sum, which should be
-        normalized
+    -> The CDF at the i-th sorted mean is the fraction of means at or below
+        it, (i + 1) / num_samples, not a cumulative sum of the means.
 
     '''
 
-    means = np.sort(np.mean(samples, axis=0))
-    cdf = np.cumsum(means) / np.sum(means)
+    means = np.sort(np.mean(samples, axis=1))
+    cdf = np.arange(1, len(means) + 1) / float(len(means))
 
     return means, cdf
 
@@ -166,7 +165,7 @@ def plot_cdf(x, cdf, conf_int=None):
 
     ax.figure.show()
 
-def load_data(file_name):
+def load_data(file_name, mmap_mode=None):
 
     ''' Loads the example distribution in numpy binary format (extension .npy).
     Loads file using numpy.load.
@@ -175,6 +174,10 @@ def load_data(file_name):
     ----------
     file_name : str
         Name of file to load.
+    mmap_mode : str, optional
+        Passed on to numpy.load. With 'r' the file is memory-mapped rather
+        than read into memory, and the functions of bootstrap_engine.py
+        bootstrap it out of core.
 
     Returns
     -------
@@ -183,7 +186,7 @@ def load_data(file_name):
 
     '''
 
-    data = np.load(file_name)
+    data = np.load(file_name, mmap_mode=mmap_mode)
 
     return data
 
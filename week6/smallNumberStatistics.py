@@ -21,20 +21,30 @@
  
  EXPORTS:
      binomialLimits
+     binomialLimitsMulti
      poissonLimits
+     poissonLimitsMulti
+     precomputeTables
      
  DEPENDENCIES:
      numpy
      scipy.special
-     sys
+     concurrent.futures
+     os
+     tempfile
+     threading
 """
 
+import os
+import tempfile
+import threading
 import numpy
+from concurrent.futures import ThreadPoolExecutor
 from scipy.special import bdtri, ndtr, pdtri
-from sys import exit
 
 
-def binomialLimits(nsuccess, ntotal, cl=None, sigma=False):
+def binomialLimits(nsuccess, ntotal, cl=None, sigma=False, validate=True,
+        workers=None):
     """
  NAME:
        binomialLimits
@@ -50,7 +60,7 @@ def binomialLimits(nsuccess, ntotal, cl=None, sigma=False):
        Statistics and probability
 
  CALLING SEQUENCE:
-       (u,l) = binomialLimits(nsuccess, ntotal, [, cl [, sigma]])
+       (u,l) = binomialLimits(nsuccess, ntotal, [, cl [, sigma [, validate [, workers]]]])
 
  INPUTS:
        nsuccess:   A strictly nonnegative integer that specifies the
@@ -71,11 +81,28 @@ def binomialLimits(nsuccess, ntotal, cl=None, sigma=False):
                is computed from the standard normal distribution with
                parameter cl.
 
+       validate:   If this is false, the type, shape and container
+                   checks are skipped. The inputs must then already be
+                   int64 (or float64) numpy arrays, and numpy arrays are
+                   always returned. Meant for hot loops where the
+                   per-call overhead matters.
+
+       workers:    Number of threads used to evaluate large inputs.
+                   The inputs are split into chunks of CHUNK_SIZE
+                   elements that are evaluated concurrently and written
+                   straight into the shared output arrays. -1 uses all
+                   CPUs. The default (None) evaluates serially. The
+                   results do not depend on the number of workers.
+
  RETURNS:
         Two lists: the first containing the upper limits, and the second
         containing the lower limits. If the inputs are numpy arrays, then
-        numpy arrays are returned instead of lists. If the inputs are scalars,
-        then scalars are returned.
+        numpy arrays of the same shape are returned instead of lists. If the
+        inputs are scalars, then scalars are returned.
+
+ RAISES:
+        TypeError if nsuccess and ntotal are not of the same type, and
+        ValueError if they do not have the same shape.
 
  REFERENCES:
        N. Gehrels. Confidence limits for small numbers of events in astrophysical
@@ -104,58 +131,25 @@ def binomialLimits(nsuccess, ntotal, cl=None, sigma=False):
     if sigma:
         cl = ndtr(cl)
 
-    if not type(nsuccess) == type(ntotal):
-        exit('nsuccess and ntotal must have the same type')
-    
-    # Since there isn't any syntactical advantage to using
-    # numpy, just convert them to lists and carry on.
-    isNumpy = False
-    if isinstance(nsuccess,numpy.ndarray):
-        nsuccess = nsuccess.tolist()
-        ntotal = ntotal.tolist()
-        isNumpy = True
-    
-    # Box single values into a list
-    isScalar = False
-    if not isinstance(nsuccess,list):
-        nsuccess = [nsuccess]
-        ntotal = [ntotal]
-        isScalar = True
+    if not validate:
+        if workers is None:
+            return _binomialArrays(nsuccess,ntotal,cl)
+        return _chunked(_binomialArrays,(nsuccess,ntotal),cl,workers)
     
-    # Must have the same length
-    if not len(nsuccess) == len(ntotal):
-        exit('nsuccess and total must have same length')
+    _checkBinomial(nsuccess,ntotal)
     
-    upper = []
-    lower = []
+    # Remember the container type so it can be restored on the way out
+    isNumpy = isinstance(nsuccess,numpy.ndarray)
+    isScalar = not isNumpy and not isinstance(nsuccess,list)
     
-    for (s,t) in zip(nsuccess,ntotal):
-        nfail = t - s
-        
-        # See Gehrels (1986) for details
-        if nfail == 0:
-            upper.append(1.0)
-        else:
-            upper.append(bdtri(s,t,1-cl))
-        
-        # See Gehrels (1986) for details
-        if s == 0:
-            lower.append(0.0)
-        else:
-            lower.append(1 - bdtri(nfail,t,1-cl))
+    (upper,lower) = _chunked(_binomialArrays,
+        (_asCounts(nsuccess),_asCounts(ntotal)),cl,workers)
     
-    if isNumpy:
-        upper = numpy.array(upper)
-        lower = numpy.array(lower)
+    return _unbox(upper,lower,isNumpy,isScalar)
 
-    # Scalar-in/scalar-out
-    if isScalar:
-        return (upper[0],lower[0])
-    
-    return (upper,lower)
 
-
-def poissonLimits(k, cl=None, sigma=False):
+def poissonLimits(k, cl=None, sigma=False, validate=True,
+        workers=None):
     """
  NAME:
        poissonLimits
@@ -171,7 +165,7 @@ def poissonLimits(k, cl=None, sigma=False):
        Statistics and probability
 
  CALLING SEQUENCE:
-       (u,l) = poissonLimits(k, [cl [, sigma]])
+       (u,l) = poissonLimits(k, [cl [, sigma [, validate [, workers]]]])
 
  INPUTS:
        k:      A strictly nonnegative integer that specifies the
@@ -187,11 +181,24 @@ def poissonLimits(k, cl=None, sigma=False):
                is computed from the standard normal distribution with
                parameter cl.
 
+       validate:   If this is false, the type, shape and container
+                   checks are skipped. The inputs must then already be
+                   int64 (or float64) numpy arrays, and numpy arrays are
+                   always returned. Meant for hot loops where the
+                   per-call overhead matters.
+
+       workers:    Number of threads used to evaluate large inputs.
+                   The inputs are split into chunks of CHUNK_SIZE
+                   elements that are evaluated concurrently and written
+                   straight into the shared output arrays. -1 uses all
+                   CPUs. The default (None) evaluates serially. The
+                   results do not depend on the number of workers.
+
  RETURNS:
         Two lists: the first containing the upper limits, and the second
         containing the lower limits. If the input is a numpy array, then
-        numpy arrays are returned instead of lists. If the input is a scalar,
-        then scalars are returned.
+        numpy arrays of the same shape are returned instead of lists. If the
+        input is a scalar, then scalars are returned.
 
  REFERENCES:
        N. Gehrels. Confidence limits for small numbers of events in astrophysical
@@ -221,38 +228,448 @@ def poissonLimits(k, cl=None, sigma=False):
     if sigma:
         cl = ndtr(cl)
 
-    # Since there isn't any syntactical advantage to using
-    # numpy, just convert it to a list and carry on.
-    isNumpy = False
-    if isinstance(k,numpy.ndarray):
-        k = k.tolist()
-        isNumpy = True
-        
-    # Box single values into a list
-    isScalar = False
-    if not isinstance(k,list):
-        k = [k]
-        isScalar = True
+    if not validate:
+        if workers is None:
+            return _poissonArrays(k,cl)
+        return _chunked(_poissonArrays,(k,),cl,workers)
     
-    upper = []
-    lower = []
+    # Remember the container type so it can be restored on the way out
+    isNumpy = isinstance(k,numpy.ndarray)
+    isScalar = not isNumpy and not isinstance(k,list)
     
-    for x in k:
-        upper.append(pdtri(x,1-cl))
-        
-        # See Gehrels (1986) for details
-        if x == 0:
-            lower.append(0.0)
-        else:
-            lower.append(pdtri(x-1,cl))
+    (upper,lower) = _chunked(_poissonArrays,(_asCounts(k),),cl,workers)
     
-    if isNumpy:
-        upper = numpy.array(upper)
-        lower = numpy.array(lower)
+    return _unbox(upper,lower,isNumpy,isScalar)
+
+
+def binomialLimitsMulti(nsuccess, ntotal, cl, sigma=False, validate=True,
+        workers=None):
+    """
+ NAME:
+       binomialLimitsMulti
+
+ PURPOSE:
+       Batch version of binomialLimits that computes the limits at
+       several confidence levels in one call. The inputs are checked
+       and converted only once.
+
+ CALLING SEQUENCE:
+       (u,l) = binomialLimitsMulti(nsuccess, ntotal, cl [, sigma [, validate [, workers]]])
+
+ INPUTS:
+       nsuccess, ntotal:   As for binomialLimits.
+
+       cl:     A scalar or sequence of confidence levels in the
+               interval [0, 1].
+
+ OPTIONS:
+       sigma:  If this is true, then the cl are assumed to be
+               multiples of sigma (see binomialLimits).
+
+       validate:   See binomialLimits.
+
+       workers:    See binomialLimits.
+
+ RETURNS:
+        Two numpy arrays of shape (len(cl),) + shape(nsuccess): the
+        first containing the upper limits, and the second containing
+        the lower limits. Row i holds the limits at confidence level
+        cl[i], identical to binomialLimits(nsuccess, ntotal, cl[i]).
+
+ EXAMPLE:
+           (u,l) = binomialLimitsMulti(20, 100, [1, 2, 3], sigma=True)
+"""
+    if validate:
+        _checkBinomial(nsuccess,ntotal)
+        (nsuccess,ntotal) = (_asCounts(nsuccess),_asCounts(ntotal))
     
-    # Scalar-in/scalar-out
-    if isScalar:
-        return (upper[0], lower[0])
+    (s,t) = numpy.broadcast_arrays(nsuccess,ntotal)
+    
+    return _multiLimits(
+        lambda c: _chunked(_binomialArrays,(s,t),c,workers),s.shape,cl,sigma)
+
+
+def poissonLimitsMulti(k, cl, sigma=False, validate=True,
+        workers=None):
+    """
+ NAME:
+       poissonLimitsMulti
+
+ PURPOSE:
+       Batch version of poissonLimits that computes the limits at
+       several confidence levels in one call. The input is checked
+       and converted only once.
+
+ CALLING SEQUENCE:
+       (u,l) = poissonLimitsMulti(k, cl [, sigma [, validate [, workers]]])
+
+ INPUTS:
+       k:      As for poissonLimits.
+
+       cl:     A scalar or sequence of confidence levels in the
+               interval [0, 1).
+
+ OPTIONS:
+       sigma:  If this is true, then the cl are assumed to be
+               multiples of sigma (see poissonLimits).
+
+       validate:   See poissonLimits.
+
+       workers:    See poissonLimits.
+
+ RETURNS:
+        Two numpy arrays of shape (len(cl),) + shape(k): the first
+        containing the upper limits, and the second containing the
+        lower limits. Row i holds the limits at confidence level
+        cl[i], identical to poissonLimits(k, cl[i]).
+
+ EXAMPLE:
+       The 1, 2 and 3 sigma limits of a count map in one call
+
+           (u,l) = poissonLimitsMulti(counts, [1, 2, 3], sigma=True)
+               u.shape = (3,) + counts.shape
+"""
+    if validate:
+        k = _asCounts(k)
+    
+    return _multiLimits(
+        lambda c: _chunked(_poissonArrays,(k,),c,workers),k.shape,cl,sigma)
+
+
+def precomputeTables():
+    """
+ NAME:
+       precomputeTables
+
+ PURPOSE:
+       Builds the lookup tables of precomputed limits and writes them
+       to the on-disk cache, so that later processes only have to
+       memory-map them. Calling this is optional: the tables are also
+       built on first use.
+
+ CALLING SEQUENCE:
+       paths = precomputeTables()
+
+ RETURNS:
+        A list with the paths of the Poisson and binomial table files.
+
+ NOTES:
+        The tables cover 0 <= k < TABLE_KMAX for poissonLimits and
+        0 <= nsuccess <= ntotal <= TABLE_NMAX for binomialLimits, at
+        the confidence levels of TABLE_SIGMAS (with sigma=True). Any
+        other input is computed directly with pdtri/bdtri. Because the
+        tables are built with those same functions, a table hit returns
+        exactly the value the direct computation would.
+
+        The cache files live in $SMALLNUMBERSTATISTICS_CACHE if it is
+        set, and in ~/.cache/smallNumberStatistics otherwise.
+"""
+    paths = []
+    for kind in ('poisson','binomial'):
+        path = _tablePath(kind)
+        if not os.path.exists(path):
+            _writeTable(path,_buildTable(kind))
+        with _tablesLock:
+            _tables.pop(kind,None)
+            for i in range(len(_TABLE_CLS)):
+                _tableSlices.pop((kind,i),None)
+        paths.append(path)
+    
+    return paths
+
+
+# Lookup tables for the most common calls: small integer counts at
+# 1, 2 and 3 sigma. Bump TABLE_VERSION whenever the layout or the grid
+# changes so that stale cache files are never picked up.
+TABLE_VERSION = 1
+TABLE_KMAX = 1000
+TABLE_NMAX = 200
+TABLE_SIGMAS = (1.0, 2.0, 3.0)
+
+_TABLE_CLS = ndtr(numpy.array(TABLE_SIGMAS))
+_tables = {}
+_tablesLock = threading.Lock()
+
+# Index of each tabulated confidence level, and the (2, ...) table slice
+# of every (kind, index) already loaded. Both are read without the lock.
+_TABLE_INDEX = dict((float(cl),i) for (i,cl) in enumerate(_TABLE_CLS))
+_tableSlices = {}
+
+# Number of elements handed to each worker thread by _chunked
+CHUNK_SIZE = 1 << 18
+
+
+def _tablePath(kind):
+    cacheDir = os.environ.get('SMALLNUMBERSTATISTICS_CACHE',
+        os.path.join(os.path.expanduser('~'),'.cache','smallNumberStatistics'))
+    
+    size = TABLE_KMAX if kind == 'poisson' else TABLE_NMAX
+    name = 'gehrels_%s_v%d_n%d.npy' % (kind,TABLE_VERSION,size)
+    return os.path.join(cacheDir,name)
+
+
+def _buildTable(kind):
+    """
+    Computes the table for one distribution. The layout is
+    (2, len(TABLE_SIGMAS), ...) with the upper limits first and the
+    lower limits second. Poisson tables are indexed by k and binomial
+    tables by (nsuccess, ntotal); entries with nsuccess > ntotal are NaN.
+    """
+    if kind == 'poisson':
+        table = numpy.empty((2,len(_TABLE_CLS),TABLE_KMAX))
+        k = numpy.arange(TABLE_KMAX,dtype=numpy.int64)
+        for (i,cl) in enumerate(_TABLE_CLS):
+            (table[0,i],table[1,i]) = _poissonDirect(k,cl)
+    else:
+        n = TABLE_NMAX + 1
+        table = numpy.full((2,len(_TABLE_CLS),n,n),numpy.nan)
+        (s,t) = numpy.indices((n,n),dtype=numpy.int64)
+        valid = s <= t
+        for (i,cl) in enumerate(_TABLE_CLS):
+            (table[0,i][valid],table[1,i][valid]) = _binomialDirect(s[valid],t[valid],cl)
+    
+    return table
+
+
+def _writeTable(path, table):
+    # Write to a temporary file first so that concurrent processes never
+    # see a partially written cache file.
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    
+    (fd,tmp) = tempfile.mkstemp(dir=directory,suffix='.npy')
+    try:
+        with os.fdopen(fd,'wb') as f:
+            numpy.save(f,table)
+        os.chmod(tmp,0o644)
+        os.replace(tmp,path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def _getTable(kind, cl):
+    """
+    Returns the (2, ...) slice of the lookup table for confidence level
+    cl, or None if cl is not one of the tabulated levels. The table is
+    memory-mapped from the cache, which is created on first use. If the
+    cache cannot be written the table is kept in memory instead.
+    """
+    if not isinstance(cl,float):
+        if not numpy.ndim(cl) == 0:
+            return None
+        cl = float(cl)
+    
+    i = _TABLE_INDEX.get(cl)
+    if i is None:
+        return None
+    
+    # Loaded tables are answered without taking the lock
+    table = _tableSlices.get((kind,i))
+    if table is not None:
+        return table
+    
+    with _tablesLock:
+        if kind not in _tables:
+            path = _tablePath(kind)
+            try:
+                _tables[kind] = numpy.load(path,mmap_mode='r')
+            except (IOError,OSError,ValueError):
+                table = _buildTable(kind)
+                try:
+                    _writeTable(path,table)
+                except (IOError,OSError):
+                    pass
+                _tables[kind] = table
+        # A plain ndarray view: indexing a numpy.memmap costs several
+        # microseconds more per call
+        _tableSlices[(kind,i)] = numpy.asarray(_tables[kind][:,i])
+    
+    return _tableSlices[(kind,i)]
+
+
+def _fromTable(table, index, hit, direct):
+    """
+    Gathers the limits for the elements flagged in hit from table and
+    calls direct(miss) for the remaining ones.
+    """
+    if hit.all():
+        return (table[0][index],table[1][index])
+    
+    upper = numpy.empty(hit.shape)
+    lower = numpy.empty(hit.shape)
+    
+    index = tuple(i[hit] for i in index)
+    upper[hit] = table[0][index]
+    lower[hit] = table[1][index]
+    
+    miss = ~hit
+    (upper[miss],lower[miss]) = direct(miss)
+    
+    return (upper,lower)
+
+
+def _binomialArrays(s, t, cl):
+    """
+    Broadcasting engine behind binomialLimits. Takes ndarrays of any
+    (broadcast-compatible) shape and returns float64 arrays of upper
+    and lower limits. Tabulated inputs are answered from the lookup
+    table, everything else is computed by _binomialDirect.
+    """
+    # _chunked has already broadcast the inputs of the threaded path
+    if not s.shape == t.shape:
+        (s,t) = numpy.broadcast_arrays(s,t)
+    
+    table = None
+    if s.dtype.kind == 'i' and t.dtype.kind == 'i':
+        table = _getTable('binomial',cl)
+    if table is None:
+        return _binomialDirect(s,t,cl)
+    
+    hit = (s >= 0) & (s <= t) & (t <= TABLE_NMAX)
+    return _fromTable(table,(s,t),hit,
+        lambda miss: _binomialDirect(s[miss],t[miss],cl))
+
+
+def _poissonArrays(k, cl):
+    """
+    Broadcasting engine behind poissonLimits. Takes an ndarray of any
+    shape and returns float64 arrays of upper and lower limits.
+    Tabulated inputs are answered from the lookup table, everything
+    else is computed by _poissonDirect.
+    """
+    table = None
+    if k.dtype.kind == 'i':
+        table = _getTable('poisson',cl)
+    if table is None:
+        return _poissonDirect(k,cl)
+    
+    hit = (k >= 0) & (k < TABLE_KMAX)
+    return _fromTable(table,(k,),hit,
+        lambda miss: _poissonDirect(k[miss],cl))
+
+
+def _binomialDirect(s, t, cl):
+    """
+    Evaluates the binomial limits with bdtri. The bdtri calls are
+    restricted to the elements where they are defined, so the results
+    are identical to evaluating the limits one element at a time.
+    """
+    nfail = t - s
+    
+    upper = numpy.ones(s.shape)
+    lower = numpy.zeros(s.shape)
+    
+    # See Gehrels (1986) for details
+    mask = nfail != 0
+    upper[mask] = bdtri(s[mask],t[mask],1-cl)
+    
+    # See Gehrels (1986) for details
+    mask = s != 0
+    lower[mask] = 1 - bdtri(nfail[mask],t[mask],1-cl)
+    
+    return (upper,lower)
+
+
+def _poissonDirect(k, cl):
+    """
+    Evaluates the Poisson limits with pdtri.
+    """
+    upper = numpy.asarray(pdtri(k,1-cl),dtype=numpy.float64)
+    lower = numpy.zeros(k.shape)
+    
+    # See Gehrels (1986) for details
+    mask = k != 0
+    lower[mask] = pdtri(k[mask]-1,cl)
     
     return (upper,lower)
 
+
+def _chunked(engine, arrays, cl, workers):
+    """
+    Evaluates engine(*arrays, cl) in chunks of CHUNK_SIZE elements on a
+    pool of threads. The scipy.special ufuncs release the GIL, so the
+    threads run in parallel, and since they share the address space the
+    input and output arrays are never copied between workers: each
+    chunk writes its limits directly into slices of the preallocated
+    outputs.
+    """
+    if workers is not None and workers < 0:
+        workers = os.cpu_count()
+    
+    arrays = list(numpy.broadcast_arrays(*arrays))
+    shape = arrays[0].shape
+    size = arrays[0].size
+    
+    if workers is None or workers <= 1 or size <= CHUNK_SIZE:
+        return engine(*(arrays + [cl]))
+    
+    flat = [numpy.ascontiguousarray(a).reshape(-1) for a in arrays]
+    upper = numpy.empty(size)
+    lower = numpy.empty(size)
+    
+    def evaluate(start):
+        chunk = slice(start,start + CHUNK_SIZE)
+        (upper[chunk],lower[chunk]) = engine(*([a[chunk] for a in flat] + [cl]))
+    
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Consume the iterator so that exceptions are propagated
+        list(pool.map(evaluate,range(0,size,CHUNK_SIZE)))
+    
+    return (upper.reshape(shape),lower.reshape(shape))
+
+
+def _multiLimits(engine, shape, cl, sigma):
+    """
+    Evaluates engine(c) for every confidence level c and stacks the
+    results into (len(cl),) + shape arrays. Each level is dispatched on
+    its own so that the tabulated ones are still answered from the
+    lookup tables.
+    """
+    cl = numpy.atleast_1d(numpy.asarray(cl,dtype=numpy.float64))
+    if sigma:
+        cl = ndtr(cl)
+    
+    upper = numpy.empty((cl.size,) + shape)
+    lower = numpy.empty((cl.size,) + shape)
+    for (i,c) in enumerate(cl.ravel()):
+        (upper[i],lower[i]) = engine(c)
+    
+    return (upper,lower)
+
+
+def _checkBinomial(nsuccess, ntotal):
+    if not type(nsuccess) == type(ntotal):
+        raise TypeError('nsuccess and ntotal must have the same type')
+    
+    # Must have the same length
+    if not numpy.shape(nsuccess) == numpy.shape(ntotal):
+        raise ValueError('nsuccess and ntotal must have the same shape')
+
+
+def _asCounts(x):
+    """
+    Converts a scalar, list or numpy array of counts into an ndarray.
+    Integer input becomes int64 and anything else becomes float64 so
+    that scipy selects the same ufunc loop it would for Python scalars.
+    """
+    x = numpy.asarray(x)
+    if x.dtype.kind in 'biu':
+        return x.astype(numpy.int64,copy=False)
+    return x.astype(numpy.float64,copy=False)
+
+
+def _unbox(upper, lower, isNumpy, isScalar):
+    """
+    Restores the container type of the caller's input: scalars for
+    scalars, lists for lists and arrays for arrays.
+    """
+    # Scalar-in/scalar-out
+    if isScalar or upper.ndim == 0:
+        return (upper[()],lower[()])
+    
+    if isNumpy:
+        return (upper,lower)
+    
+    return (upper.tolist(),lower.tolist())
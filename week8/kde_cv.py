@@ -0,0 +1,327 @@
+#!/usr/bin/python
+
+''' Likelihood cross-validation for choosing kernel density bandwidths.
+
+Array versions of Likelihood_CV and train_h from point_data.py. The
+versions there refit the whole kernel density estimate, in Python loops, for
+every held-out point. Here the matrix of pairwise distances between the data
+is computed once, the kernel is applied to it once per bandwidth, and the
+held-out fits are obtained by subtracting contributions from the row sums.
+Bootstrap resamples are drawn all at once from a seeded generator and
+represented by how many times each datum was drawn, so that every resample's
+fit is a weighted sum over the same kernel matrix rather than a new copy of
+the data.
+
+The kernels are the kernel factories of kde.py (or point_data.py): functions
+of the bandwidth h that return an array-aware kernel, e.g. kde.gauss_kernel.
+
+'''
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from kde import TILE_SIZE, dist, euclidean
+
+def pairwise_distances(data):
+
+    ''' Matrix of distances between all pairs of data points.
+
+    Parameters
+    ----------
+    data : array-like
+        Data points, shape (N,) or (N, D).
+
+    Returns
+    -------
+    distances : array-like
+        Symmetric (N, N) array of distances.
+
+    '''
+
+    data = np.asarray(data, dtype=float)
+    if data.ndim == 1:
+        return dist(data[:, np.newaxis], data[np.newaxis, :])
+    return euclidean(data[:, np.newaxis, :], data[np.newaxis, :, :])
+
+def leave_one_out_density(h, kernel, data, distances=None):
+
+    ''' Density at every data point estimated from all the other points.
+
+    Parameters
+    ----------
+    h : float
+        Bandwidth.
+    kernel : function
+        Kernel factory, called as kernel(h).
+    data : array-like
+        Data points, shape (N,) or (N, D).
+    distances : array-like, optional
+        Precomputed pairwise_distances(data).
+
+    Returns
+    -------
+    density : array-like
+        Array of length N; element i is the estimate at data[i] from the
+        other N - 1 points.
+
+    '''
+
+    K = _kernel_matrix(h, kernel, data, distances)[0]
+
+    return np.sum(K, axis=0) / (len(K) - 1)
+
+def bootstrap_counts(N, n_boot=20, seed=None):
+
+    ''' Bootstrap resamples of N data points, as counts.
+
+    Parameters
+    ----------
+    N : int
+        Number of data points.
+    n_boot : int
+        Number of resamples.
+    seed : int or numpy.random.Generator, optional
+        Seed of the random number generator. The same seed always gives the
+        same resamples.
+
+    Returns
+    -------
+    counts : array-like
+        Integer array of shape (n_boot, N); counts[b, l] is the number of
+        times datum l was drawn in resample b. Each row sums to N.
+
+    '''
+
+    rng = np.random.default_rng(seed)
+    index = rng.integers(0, N, size=(n_boot, N))
+    index += N * np.arange(n_boot)[:, np.newaxis]
+
+    return np.bincount(index.ravel(), minlength=n_boot * N).reshape(n_boot, N)
+
+def likelihood_cv(h, kernel, data, cv_type='leave-one-out', distances=None,
+        tile_size=TILE_SIZE, n_boot=20, seed=None):
+
+    ''' Negative cross-validated log-likelihood of a bandwidth (equation 6.5).
+
+    Gives the same value as Likelihood_CV in point_data.py, which for
+    cv_type='leave-one-out' drops each point i in turn, estimates the density
+    from the other N - 1 points at all N data points and averages the summed
+    log densities over i:
+
+        -L_CV = -1/N sum_i sum_j log( 1/(N-1) sum_{l != i} K(x_j - x_l) )
+
+    Rather than refitting N times, the kernel matrix K_jl is computed once.
+    With S_j the sum of row j, the inner sum is S_j - K_ji, so every held-out
+    density comes from one subtraction. The diagonal (self) terms are kept
+    apart so that the i = j densities, which can be tiny, do not suffer from
+    cancellation.
+
+    For cv_type='bootstrap' the density is estimated at all N data points
+    from each of n_boot resamples of the data, drawn with replacement, and
+    the summed log densities are averaged over the resamples:
+
+        -L_CV = -1/B sum_b sum_j log( 1/N sum_l c_bl K(x_j - x_l) )
+
+    where c_bl is the number of times datum l was drawn in resample b (see
+    bootstrap_counts). Unlike point_data.py, the resamples come from a
+    seeded generator, so the result is reproducible; with a fixed seed every
+    bandwidth is scored on the same resamples.
+
+    Parameters
+    ----------
+    h : float
+        Bandwidth.
+    kernel : function
+        Kernel factory, called as kernel(h).
+    data : array-like
+        Data points, shape (N,) or (N, D).
+    cv_type : str
+        'leave-one-out' or 'bootstrap'.
+    distances : array-like, optional
+        Precomputed pairwise_distances(data), to be shared between calls
+        with different h.
+    tile_size : int
+        Maximum number of matrix elements whose logarithm is taken at once.
+    n_boot : int
+        Number of bootstrap resamples.
+    seed : int or numpy.random.Generator, optional
+        Seed of the bootstrap resamples.
+
+    Returns
+    -------
+    cv : float
+        Negative cross-validated log-likelihood. Smaller is better.
+
+    Examples
+    --------
+    >>> from kde import gauss_kernel
+    >>> data = np.random.randn(2000)
+    >>> likelihood_cv(0.2, gauss_kernel, data)
+
+    '''
+
+    if cv_type == 'bootstrap':
+        return _bootstrap_cv(h, kernel, data, distances, tile_size,
+                             bootstrap_counts(len(data), n_boot, seed))
+    if cv_type != 'leave-one-out':
+        raise ValueError("cv_type must be 'leave-one-out' or 'bootstrap'")
+
+    K, self_terms = _kernel_matrix(h, kernel, data, distances)
+    N = len(K)
+
+    # Row sums without and with the self terms
+    others = np.sum(K, axis=0)
+    totals = others + self_terms
+
+    P = 0.
+    step = max(1, tile_size // N)
+    for start in range(0, N, step):
+        # Row i of the block holds S_j - K_ji for every j. The i = j
+        # elements are set from the sums without the self terms directly,
+        # since subtracting the large self term could cancel them to zero.
+        block = totals - K[start:start + step]
+        rows = np.arange(len(block))
+        block[rows, start + rows] = others[start + rows]
+        P += np.sum(np.log(block / (N - 1))) / N
+
+    return -P
+
+def train_h(kernel, data, hrange=[-2, 2, 50], cv_type='leave-one-out',
+        workers=None, search='grid', coarse=5, return_curve=False,
+        n_boot=20, seed=None):
+
+    ''' Finds the bandwidth that minimizes likelihood_cv over a log-spaced
+    grid, numpy.logspace(*hrange).
+
+    The pairwise distance matrix is computed once and shared by all the
+    candidate bandwidths, which are evaluated in parallel on a pool of
+    threads (numpy releases the GIL in the kernel and logarithm loops, and
+    the threads share the distance matrix without copying it). With
+    cv_type='bootstrap' the resamples are also drawn once, so every
+    candidate is scored on the same resamples and the result does not depend
+    on the number of workers.
+
+    Parameters
+    ----------
+    kernel : function
+        Kernel factory, called as kernel(h).
+    data : array-like
+        Data points, shape (N,) or (N, D).
+    hrange : list
+        Arguments of numpy.logspace defining the candidate bandwidths.
+    cv_type : str
+        Passed on to likelihood_cv.
+    workers : int, optional
+        Number of threads. The default evaluates the candidates one after
+        the other.
+    search : str
+        'grid' evaluates every candidate. 'golden' first evaluates every
+        coarse-th candidate, then runs a golden-section search over the
+        candidates between the neighbors of the coarse minimum. It needs
+        far fewer evaluations and returns the same hmin as 'grid' as long
+        as the CV curve has a single minimum in that bracket.
+    coarse : int
+        Stride of the first pass of the 'golden' search.
+    return_curve : bool
+        Also return the evaluated bandwidths and CV values.
+    n_boot : int
+        Number of bootstrap resamples, for cv_type='bootstrap'.
+    seed : int or numpy.random.Generator, optional
+        Seed of the bootstrap resamples.
+
+    Returns
+    -------
+    hmin : float
+        The bandwidth with the smallest CV value.
+    h_list, cv_list : array-like
+        Only if return_curve is True: the bandwidths that were evaluated, in
+        increasing order, and their CV values.
+
+    Examples
+    --------
+    >>> from kde import gauss_kernel
+    >>> data = np.random.randn(3000)
+    >>> hmin = train_h(gauss_kernel, data, workers=8, search='golden')
+
+    '''
+
+    h_list = np.logspace(*hrange)
+    distances = pairwise_distances(data)
+    cv = {}
+
+    if cv_type == 'bootstrap':
+        counts = bootstrap_counts(len(distances), n_boot, seed)
+        score = lambda i: _bootstrap_cv(h_list[i], kernel, data, distances,
+                                        TILE_SIZE, counts)
+    else:
+        score = lambda i: likelihood_cv(h_list[i], kernel, data, cv_type,
+                                        distances)
+
+    def evaluate(indices):
+        indices = [i for i in indices if i not in cv]
+        if workers is None or workers <= 1 or len(indices) < 2:
+            values = [score(i) for i in indices]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                values = list(pool.map(score, indices))
+        cv.update(zip(indices, values))
+
+    if search == 'grid':
+        evaluate(range(len(h_list)))
+        lo, hi = 0, len(h_list) - 1
+    elif search == 'golden':
+        evaluate(range(0, len(h_list), coarse))
+        best = min(cv, key=lambda i: (cv[i], i))
+        lo, hi = max(0, best - coarse), min(len(h_list) - 1, best + coarse)
+
+        # Golden-section search over the integer indices in [lo, hi]
+        ratio = (3 - np.sqrt(5)) / 2
+        while hi - lo > 3:
+            a = lo + int(ratio * (hi - lo))
+            b = hi - int(ratio * (hi - lo))
+            evaluate([a, b])
+            if cv[a] <= cv[b]:
+                hi = b
+            else:
+                lo = a
+        evaluate(range(lo, hi + 1))
+    else:
+        raise ValueError("search must be 'grid' or 'golden'")
+
+    # Ties go to the smaller bandwidth, as with numpy.argmin over the grid
+    hmin = h_list[min(range(lo, hi + 1), key=lambda i: (cv[i], i))]
+
+    if return_curve:
+        indices = sorted(cv)
+        return hmin, h_list[indices], np.array([cv[i] for i in indices])
+    return hmin
+
+def _bootstrap_cv(h, kernel, data, distances, tile_size, counts):
+
+    # Bootstrap branch of likelihood_cv for given resample counts. Row b of
+    # counts @ K is the summed kernel at every datum from resample b (K is
+    # symmetric); tiles of resamples keep the products within tile_size.
+    K, self_terms = _kernel_matrix(h, kernel, data, distances)
+    N = len(K)
+    K[np.diag_indices(N)] = self_terms
+
+    P = 0.
+    step = max(1, tile_size // N)
+    for start in range(0, len(counts), step):
+        density = np.dot(counts[start:start + step], K) / N
+        P += np.sum(np.log(density))
+
+    return -P / len(counts)
+
+def _kernel_matrix(h, kernel, data, distances):
+
+    # Kernel applied to the pairwise distances, with the diagonal (self)
+    # terms set to zero and returned separately.
+    if distances is None:
+        distances = pairwise_distances(data)
+
+    K = np.array(np.broadcast_to(kernel(h)(distances), distances.shape))
+    self_terms = np.diagonal(K).copy()
+    np.fill_diagonal(K, 0.)
+
+    return K, self_terms
+